@@ -21,6 +21,8 @@
 #
 # [RMI]
 #     poll_interval = 2          # number of seconds
+#     cache_ttl = 300            # optional, seconds to reuse fetched RMI data,
+#                                # by default every poll fetches fresh data
 #     driver = user.rmi
 #     enable = true              # only used by the service
 #     binding = loop            # only used by the service
@@ -35,10 +37,17 @@
 #     ...
 #     [[field_map]]
 #         extraTemp1 = outTemp
+#
+# The rain rate is derived from the radar forecast and is available as the
+# rain_rate field. It is mapped to rainRate by default; a custom field_map that
+# leaves it out skips the radar forecast entirely.
 
 import aiohttp
 import asyncio
+import bisect
+import calendar
 import logging
+import re
 import time
 import weewx.drivers
 import weewx.engine
@@ -46,24 +55,82 @@ from irm_kmi_api import IrmKmiApiClientHa
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
+try:
+    import uvloop
+
+    _new_event_loop = uvloop.new_event_loop
+except ImportError:
+    _new_event_loop = asyncio.new_event_loop
+
 DRIVER_NAME = "RMI"
 DRIVER_VERSION = "0.1"
 log = logging.getLogger(__name__)
 
+_BRUSSELS_TZ = ZoneInfo("Europe/Brussels")
+_CLOUD_COVER = {"sunny": 0, "clear-night": 0, "cloudy": 50}
+
 
-def _get_as_float(data, key):
-    v = None
-    if key in data and data.get(key):
-        try:
-            v = float(data[key])
-        except ValueError as e:
-            log.error("cannot read value for '%s': %s" % (data[key], e))
+_ISO_RE = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})([+-])(\d{2}):(\d{2})"
+)
+
+
+def _identity(v):
     return v
 
 
+def _to_epoch(s):
+    """Convert an RMI timestamp (YYYY-MM-DDTHH:MM:SS+HH:MM) to epoch seconds."""
+    m = _ISO_RE.fullmatch(s)
+    if m is None:
+        return datetime.fromisoformat(s).timestamp()
+    year, month, day, hour, minute, second, sign, tz_h, tz_m = m.groups()
+    offset = int(tz_h) * 3600 + int(tz_m) * 60
+    if sign == "-":
+        offset = -offset
+    return (
+        calendar.timegm(
+            (int(year), int(month), int(day), int(hour), int(minute), int(second))
+        )
+        - offset
+    )
+
+
+def _coerce(v):
+    if isinstance(v, float):
+        return v
+    if isinstance(v, int):
+        return float(v)
+    if not v:
+        return None
+    try:
+        return float(v)
+    except ValueError as e:
+        log.error("cannot read value for '%s': %s" % (v, e))
+    return None
+
+
 class RMIDataFetcher:
     """Fetches weather data from the RMI API."""
 
+    __slots__ = (
+        "poll_interval",
+        "cache_ttl",
+        "latitude",
+        "longitude",
+        "_obs_map",
+        "_radar_fields",
+        "_need_radar",
+        "_plan",
+        "_packet_template",
+        "_session",
+        "_client",
+        "_forecasts",
+        "_forecast_timestamps",
+        "_timestamp_memo",
+        "_cache_expiry",
+    )
+
     DEFAULT_FIELD_MAP = {
         "barometer": "pressure",
         "outTemp": "temperature",
@@ -71,10 +138,12 @@ class RMIDataFetcher:
         "windGust": "wind_speed_gust",
         "windDir": "wind_bearing",
         "cloudcover": "condition",
+        "rainRate": "rain_rate",
     }
 
     def __init__(self, **stn_dict):
         self.poll_interval = float(stn_dict.get("poll_interval", 60))
+        self.cache_ttl = float(stn_dict.get("cache_ttl", 0))
         self.latitude = float(stn_dict.get("latitude"))
         self.longitude = float(stn_dict.get("longitude"))
         obs_map = stn_dict.pop("field_map", None)
@@ -83,52 +152,123 @@ class RMIDataFetcher:
             obs_map = self.default_field_map()
         obs_map.update(obs_map_ext)
         self._obs_map = obs_map
+        self._radar_fields = [
+            weewx_field
+            for weewx_field, rmi_field in obs_map.items()
+            if rmi_field == "rain_rate"
+        ]
+        self._need_radar = bool(self._radar_fields)
+        # The mapping never changes, so resolve the transform for each field
+        # once instead of branching on the RMI field name every poll.
+        self._plan = [
+            (
+                weewx_field,
+                rmi_field,
+                self.get_cloud_cover if rmi_field == "condition" else _identity,
+            )
+            for weewx_field, rmi_field in obs_map.items()
+            if rmi_field != "rain_rate"
+        ]
+        self._packet_template = dict.fromkeys(
+            weewx_field for weewx_field, _, _ in self._plan
+        )
+        self._session = None
+        self._client = None
+        self._forecasts = []
+        self._forecast_timestamps = []
+        self._timestamp_memo = {}
+        self._cache_expiry = 0.0
         log.info("Polling interval is %s" % self.poll_interval)
+        log.info("Cache TTL is %s" % self.cache_ttl)
         log.info("Latitude is %s" % self.latitude)
         log.info("Longitude is %s" % self.longitude)
+        if not self._need_radar:
+            log.info("No field mapped to rain_rate, not reading the radar forecast")
 
-    async def get_weather_packet(self):
-        session = aiohttp.ClientSession()
-        client = IrmKmiApiClientHa(
-            session=session, user_agent="boosterl/weewx-rmi driver"
-        )
-        try:
-            await client.refresh_forecasts_coord(
-                {"lat": self.latitude, "long": self.longitude}
+    def _get_client(self):
+        # Keep one session, and with it a pool of kept-alive connections, for
+        # as long as the fetcher lives. The owner always runs the fetcher on
+        # the same event loop.
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=4,
+                    limit_per_host=2,
+                    keepalive_timeout=75,
+                    use_dns_cache=True,
+                    ttl_dns_cache=3600,
+                ),
             )
-            await session.close()
-        except Exception:
-            log.error("Error connecting to RMI api")
-            return dict()
-        weather = client.get_current_weather(tz=ZoneInfo("Europe/Brussels"))
-        packet = dict()
-        for weewx_field, rmi_field in self._obs_map.items():
-            if rmi_field == "condition":
-                packet[weewx_field] = self.get_cloud_cover(weather.get(rmi_field))
-                continue
-            packet[weewx_field] = weather.get(rmi_field)
-        forecasts = client.get_radar_forecast()
-        prev = forecasts[0]
-        for forecast in forecasts:
-            dt_timestamp = datetime.strptime(
-                forecast.get("datetime"), "%Y-%m-%dT%H:%M:%S%z"
-            ).timestamp()
-            if dt_timestamp > time.time():
-                packet["rainRate"] = prev.get("native_precipitation") * 6
-                break
-            prev = forecast
+            self._client = IrmKmiApiClientHa(
+                session=self._session, user_agent="boosterl/weewx-rmi driver"
+            )
+            self._cache_expiry = 0.0
+        return self._client
+
+    async def aclose(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._cache_expiry = 0.0
+        self._session = None
+        self._client = None
+
+    async def get_weather_packet(self):
+        _mono = time.monotonic
+        client = self._get_client()
+        # RMI only updates its data every few minutes; until the cache
+        # expires, build the packet from the data the client already holds.
+        start = _mono()
+        if start >= self._cache_expiry:
+            try:
+                await client.refresh_forecasts_coord(
+                    {"lat": self.latitude, "long": self.longitude}
+                )
+            except Exception:
+                log.error("Error connecting to RMI api")
+                return dict()
+            if self._need_radar:
+                self._forecasts = client.get_radar_forecast()
+                self._forecast_timestamps = self._parse_timestamps(self._forecasts)
+            # Count from the start of the fetch, like the poll schedule, so
+            # the fetch duration does not stretch the TTL.
+            self._cache_expiry = start + self.cache_ttl
+        weather_get = client.get_current_weather(tz=_BRUSSELS_TZ).get
+        packet = self._packet_template.copy()
+        for weewx_field, rmi_field, transform in self._plan:
+            packet[weewx_field] = transform(weather_get(rmi_field))
+        if self._need_radar:
+            timestamps = self._forecast_timestamps
+            i = bisect.bisect_right(timestamps, time.time())
+            if i < len(timestamps):
+                prev = self._forecasts[max(i - 1, 0)]
+                rain_rate = prev.get("native_precipitation") * 6
+                for weewx_field in self._radar_fields:
+                    packet[weewx_field] = rain_rate
         return packet
 
+    def _parse_timestamps(self, forecasts):
+        # Consecutive refreshes mostly return the same forecast entries, so
+        # remember parsed timestamps by their raw string. Only the keys of the
+        # current forecast are kept, which keeps the memo bounded.
+        memo = self._timestamp_memo
+        new_memo = {}
+        timestamps = []
+        for forecast in forecasts:
+            s = forecast.get("datetime")
+            ts = memo.get(s)
+            if ts is None:
+                ts = _to_epoch(s)
+            new_memo[s] = ts
+            timestamps.append(ts)
+        self._timestamp_memo = new_memo
+        return timestamps
+
     def default_field_map(self):
         return RMIDataFetcher.DEFAULT_FIELD_MAP
 
     @staticmethod
     def get_cloud_cover(condition):
-        if condition in ["sunny", "clear-night"]:
-            return 0
-        if condition in ["cloudy"]:
-            return 50
-        return 100
+        return _CLOUD_COVER.get(condition, 100)
 
 
 class RMIDriver(weewx.drivers.AbstractDevice):
@@ -139,19 +279,41 @@ class RMIDriver(weewx.drivers.AbstractDevice):
         stn_dict.setdefault("latitude", self.engine.stn_info.latitude_f)
         stn_dict.setdefault("longitude", self.engine.stn_info.longitude_f)
         self.fetcher = RMIDataFetcher(**stn_dict)
+        self._loop = _new_event_loop()
 
     def genLoopPackets(self):
+        _time = time.time
+        _sleep = time.sleep
+        _mono = time.monotonic
+        _METRIC = weewx.METRIC
+        _log_err = log.error
+        run_until_complete = self._loop.run_until_complete
+        get_weather_packet = self.fetcher.get_weather_packet
+        poll_interval = self.fetcher.poll_interval
+        next_tick = _mono() + poll_interval
         while True:
             data = {}
             try:
-                data = asyncio.run(self.fetcher.get_weather_packet())
+                data = run_until_complete(get_weather_packet())
             except Exception as e:
-                log.error("read failed: %s" % e)
-            _packet = {"dateTime": int(time.time()), "usUnits": weewx.METRIC}
-            for vname in data:
-                _packet[vname] = _get_as_float(data, vname)
+                _log_err("read failed: %s" % e)
+            _packet = {"dateTime": int(_time()), "usUnits": _METRIC}
+            for vname, value in data.items():
+                _packet[vname] = _coerce(value)
             yield _packet
-            time.sleep(self.fetcher.poll_interval)
+            # Sleep until the next tick rather than a full interval, so the
+            # time spent fetching does not make the cadence drift.
+            delay = next_tick - _mono()
+            if delay > 0:
+                _sleep(delay)
+                next_tick += poll_interval
+            else:
+                next_tick = _mono() + poll_interval
+
+    def closePort(self):
+        if not self._loop.is_closed():
+            self._loop.run_until_complete(self.fetcher.aclose())
+            self._loop.close()
 
     @property
     def hardware_name(self):
@@ -168,6 +330,7 @@ class RMIService(weewx.engine.StdService):
             "longitude", self.engine.stn_info.longitude_f
         )
         self.fetcher = RMIDataFetcher(**config_dict[DRIVER_NAME])
+        self._loop = _new_event_loop()
         self.binding = config_dict[DRIVER_NAME].get("binding", "loop")
         self.enable = config_dict[DRIVER_NAME].get("enable", True)
         if not self.enable:
@@ -187,12 +350,17 @@ class RMIService(weewx.engine.StdService):
         self._process_packet_or_record(event)
 
     def _process_packet_or_record(self, event):
-        data = asyncio.run(self.fetcher.get_weather_packet())
+        data = self._loop.run_until_complete(self.fetcher.get_weather_packet())
         data["usUnits"] = weewx.METRIC
         converter = weewx.units.StdUnitConverters[event.packet["usUnits"]]
         converted_data = converter.convertDict(data)
-        for vname in converted_data:
-            event.packet[vname] = _get_as_float(converted_data, vname)
+        for vname, value in converted_data.items():
+            event.packet[vname] = _coerce(value)
+
+    def shutDown(self):
+        if not self._loop.is_closed():
+            self._loop.run_until_complete(self.fetcher.aclose())
+            self._loop.close()
 
 
 def loader(config_dict, engine):